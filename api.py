@@ -2,16 +2,33 @@ from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.responses import FileResponse, StreamingResponse
 from openpyxl import load_workbook
 from openpyxl.cell.cell import MergedCell
-from openpyxl.utils import range_boundaries
+from openpyxl.utils import range_boundaries, coordinate_to_tuple, get_column_letter
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.background import BackgroundTask
+from xml.etree.ElementTree import iterparse
+import asyncio
+import hashlib
 import json
+import orjson
 import os
 import re
-from openai import OpenAI
+import shutil
+import threading
+from openai import AsyncOpenAI, BadRequestError
 from io import BytesIO
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Dict, List, Optional
 import uuid
 import tempfile
+import zipfile
+
+try:
+    import ahocorasick  # pyahocorasick, optional C extension for keyword matching
+except ImportError:
+    ahocorasick = None
 
 app = FastAPI(title="Excel Form Filler API", description="API to detect and fill form fields in Excel files using AI")
 
@@ -24,6 +41,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress JSON responses (/detect can list thousands of fields); .xlsx and .zip
+# downloads are already deflated, so they're passed through untouched
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=1024,
+    exclude_content_types=(
+        "application/zip",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ),
+)
+
 # Spanish form field keywords commonly found in bank documents
 LABEL_KEYWORDS = [
     'nombre', 'dirección', 'teléfono', 'telefono', 'email', 'correo', 'fecha',
@@ -37,269 +65,567 @@ LABEL_KEYWORDS = [
     'firma', 'fecha de', 'lugar de', 'hora', 'folio', 'referencia', 'número', 'numero'
 ]
 
-# Helper functions
-def is_merged_cell_but_not_top_left(cell):
-    """Check if cell is a MergedCell (not the writable top-left)"""
-    return isinstance(cell, MergedCell)
+def _minimal_keywords(keywords):
+    """Drop duplicates and keywords containing a shorter keyword ('fecha de' is implied
+    by 'fecha'): they can never change whether the text contains some keyword"""
+    unique = sorted(set(keyword.lower() for keyword in keywords), key=len)
+    minimal = []
+    for keyword in unique:
+        if not any(shorter in keyword for shorter in minimal):
+            minimal.append(keyword)
+    return minimal
 
-def is_top_left_of_merged(cell_coord, merged_map):
-    """Check if a cell coordinate is the top-left of any merged range"""
-    for merged_range, top_left in merged_map.items():
-        if cell_coord == top_left:
-            return True
-    return False
+# One Aho-Corasick pass over the lowercased text finds any keyword when pyahocorasick is installed
+if ahocorasick is not None:
+    LABEL_KEYWORD_AUTOMATON = ahocorasick.Automaton()
+    for keyword in _minimal_keywords(LABEL_KEYWORDS):
+        LABEL_KEYWORD_AUTOMATON.add_word(keyword, keyword)
+    LABEL_KEYWORD_AUTOMATON.make_automaton()
+else:
+    LABEL_KEYWORD_AUTOMATON = None
 
-def get_cell_value(cell):
-    """Safely get cell value, handling MergedCell"""
-    if isinstance(cell, MergedCell):
-        return None
-    return cell.value
+# Otherwise a single case-insensitive alternation so the keyword check is one scan of the text
+LABEL_KEYWORD_RE = re.compile("|".join(re.escape(keyword) for keyword in _minimal_keywords(LABEL_KEYWORDS)), re.IGNORECASE)
+DIGIT_RE = re.compile(r'\d')  # existence test only, so match a single digit
+LONG_DIGITS_RE = re.compile(r'\d{3,}')
+
+def has_label_keyword(text):
+    """Check if text contains any of the LABEL_KEYWORDS (case-insensitive)"""
+    if LABEL_KEYWORD_AUTOMATON is not None:
+        return next(LABEL_KEYWORD_AUTOMATON.iter(text.lower()), None) is not None
+    return LABEL_KEYWORD_RE.search(text) is not None
+
+AI_MODEL = "gpt-4o-mini"
+AI_MAX_TOKENS = 4096
+# Cap on concurrent chat completion calls (e.g. the per-file fallback of /process_many)
+AI_MAX_CONCURRENCY = 8
+
+# System prompts are kept byte-identical across calls (nothing interpolated)
+# so OpenAI's automatic prompt caching can reuse the prefix
+AI_SYSTEM_PROMPT = """You are a helpful assistant that generates realistic sample data for form fields. Always return complete, valid JSON objects. Never return incomplete or truncated JSON. Ensure all field names from the user's list are included as keys.
+
+IMPORTANT: Return ONLY a complete, valid JSON object. The JSON must:
+1. Have each field name as a key (exactly as listed by the user)
+2. Have appropriate sample data as the value for each key
+3. Be complete and properly closed (all brackets and braces must be closed)
+4. Be valid JSON that can be parsed
+
+Return ONLY the JSON object, no explanations, no markdown, no code blocks.
+
+Example format:
+{"Full Name": "John Doe", "Address": "123 Main St, City, Country", "DOB": "01-15-1990", "Gender": "Male"}"""
+
+AI_MULTI_FILE_SYSTEM_PROMPT = """You are a helpful assistant that generates realistic sample data for the form fields of several files. The user gives the fields of each file as a JSON object mapping file id to field names. Always return complete, valid JSON objects. Never return incomplete or truncated JSON. Ensure all file ids and field names from the user's list are included as keys.
+
+IMPORTANT: Return ONLY a complete, valid JSON object. The JSON must:
+1. Have each file id as a key (exactly as given by the user)
+2. Have as value an object with each field name of that file as a key and appropriate sample data as the value
+3. Be complete and properly closed (all brackets and braces must be closed)
+4. Be valid JSON that can be parsed
+
+Return ONLY the JSON object, no explanations, no markdown, no code blocks.
+
+Example format:
+{"file-0": {"Full Name": "John Doe", "DOB": "01-15-1990"}, "file-1": {"Address": "123 Main St, City, Country"}}"""
+
+JSON_DECODER = json.JSONDecoder()
+
+# Shared across requests so the HTTP connection pool is reused
+_openai_client: Optional[AsyncOpenAI] = None
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_SIZE = 20 * 1024 * 1024
+# Filled outputs stay in memory up to this size, then spill to disk
+SPOOLED_OUTPUT_MAX_SIZE = 8 * 1024 * 1024
+
+# LRU of detect_fields results keyed by upload content hash
+DETECTION_CACHE_SIZE = 128
+_detection_cache = OrderedDict()
+_detection_cache_lock = threading.Lock()
+
+# LRU of AI-generated data keyed by the (sorted) field labels, so repeated
+# templates skip the OpenAI round-trip
+AI_CACHE_SIZE = 512
+_ai_cache = OrderedDict()
+_ai_cache_lock = threading.Lock()
+# AI calls in progress by cache key (only touched from the event loop)
+_ai_inflight: Dict[str, asyncio.Task] = {}
+_ai_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+
+# Uploaded workbooks waiting on an OpenAI batch job, one directory per batch id
+BATCH_JOBS_DIR = os.path.join(tempfile.gettempdir(), "excel_form_filler_batches")
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+MERGE_CELL_TAG = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}mergeCell"
+
+# Helper functions
+def get_merged_ranges(ws):
+    """Get merged range coordinates, also for read-only worksheets"""
+    if hasattr(ws, "merged_cells"):
+        return [r.coord for r in ws.merged_cells.ranges]
+    # Read-only worksheets don't expose merged cells, read them from the sheet XML
+    ranges = []
+    with ws._get_source() as src:
+        for _, element in iterparse(src):
+            if element.tag == MERGE_CELL_TAG:
+                ranges.append(element.get("ref"))
+            element.clear()
+    return ranges
+
+def is_value_empty(value):
+    """Check if a cell value is empty or contains only whitespace"""
+    # isspace() tests in place instead of allocating a stripped copy
+    return value is None or (type(value) is str and (not value or value.isspace()))
 
 def is_cell_empty(cell):
     """Check if a cell is empty or contains only whitespace"""
     if isinstance(cell, MergedCell):
         return True
-    value = cell.value
-    return value is None or (isinstance(value, str) and value.strip() == "")
+    return is_value_empty(cell.value)
 
-def find_field_cell(label_cell, merged_map, ws):
-    """Find the field cell that's associated with a label cell."""
-    row_idx = label_cell.row
-    col_idx = label_cell.column
+def read_grid(ws):
+    """Snapshot the worksheet into a {(row, col): value} dict of non-empty cells.
     
-    if is_merged_cell_but_not_top_left(label_cell):
-        return None
+    Empty and whitespace-only cells are left out, so a position missing
+    from the grid is an empty cell.
+    """
+    # A read-only sheet iterates up to its declared <dimension>, which can be stale
+    # (too small) in files written by other tools: read the actual rows instead
+    if hasattr(ws, "reset_dimensions"):
+        ws.reset_dimensions()
+    grid = {}
+    for row_idx, row in enumerate(ws.iter_rows(values_only=True), start=1):
+        # Blank rows in the styled area come back as all-None tuples: skip them with one C-level count
+        if row.count(None) == len(row):
+            continue
+        for col_idx, value in enumerate(row, start=1):
+            if not is_value_empty(value):
+                grid[(row_idx, col_idx)] = value
+    return grid
+
+def build_merge_index(merged_map):
+    """Index merged ranges by row: {row: ([min_col, ...], [(min_col, max_col, min_row, merged_range, top_left), ...])}
+    
+    Each row's entries are sorted by min_col. Merged ranges never overlap,
+    so a bisect on min_col finds the only range that can hold a cell.
+    """
+    entries_by_row = {}
+    for merged_range, top_left in merged_map.items():
+        min_col, min_row, max_col, max_row = range_boundaries(merged_range)
+        entry = (min_col, max_col, min_row, merged_range, top_left)
+        for row in range(min_row, max_row + 1):
+            entries_by_row.setdefault(row, []).append(entry)
     
-    if is_top_left_of_merged(label_cell.coordinate, merged_map):
+    merge_index = {}
+    for row, entries in entries_by_row.items():
+        entries.sort()
+        merge_index[row] = ([entry[0] for entry in entries], entries)
+    return merge_index
+
+def find_merged_range(row, column, merge_index):
+    """Return the merge index entry containing a cell, or None"""
+    bucket = merge_index.get(row)
+    if bucket is None:
         return None
+    min_cols, entries = bucket
+    position = bisect_right(min_cols, column) - 1
+    if position >= 0 and column <= entries[position][1]:
+        return entries[position]
+    return None
+
+def find_field_cell(row_idx, col_idx, grid, merge_index):
+    """Find the field cell that's associated with the label at (row_idx, col_idx).
     
-    directions = [(0, 1), (1, 0), (0, -1)]  # Right, Below, Left
+    Callers have already skipped labels sitting on a merged range's top-left.
+    """
+    # Right, Below, Left - only the left candidate can fall off the sheet
+    candidates = ((row_idx, col_idx + 1), (row_idx + 1, col_idx), (row_idx, col_idx - 1))
     
-    for row_offset, col_offset in directions:
-        field_row = row_idx + row_offset
-        field_col = col_idx + col_offset
-        
-        if field_row < 1 or field_col < 1:
+    for field_row, field_col in candidates:
+        if field_col < 1:
             continue
         
-        for merged_range, top_left in merged_map.items():
-            try:
-                min_col, min_row, max_col, max_row = range_boundaries(merged_range)
-                if min_row <= field_row <= max_row and min_col <= field_col <= max_col:
-                    top_left_cell = ws[top_left]
-                    if is_cell_empty(top_left_cell):
-                        return merged_range
-                    else:
-                        break
-            except:
-                continue
+        merged = find_merged_range(field_row, field_col, merge_index)
+        if merged is not None:
+            min_col, _, min_row, merged_range, _ = merged
+            if (min_row, min_col) not in grid:
+                return merged_range
         
-        try:
-            field_cell = ws.cell(row=field_row, column=field_col)
-            if is_cell_empty(field_cell):
-                return field_cell.coordinate
-        except:
-            pass
+        if (field_row, field_col) not in grid:
+            return f"{get_column_letter(field_col)}{field_row}"
     
     return None
 
 def looks_like_label(text):
-    """Determine if text looks like a form label rather than a field value"""
+    """Determine if text looks like a form label rather than a field value.
+    
+    Text that can't be a label by length alone is rejected here, uncached,
+    so the cache below only ever holds short strings (cells can hold up to
+    32k characters of user data).
+    """
+    if not text or not isinstance(text, str):
+        return False
+    if len(text) > 100:
+        text = text.strip()
+        if len(text) > 100:
+            return False
+    return _looks_like_label_cached(text)
+
+@lru_cache(maxsize=4096)  # pure function of the text; templates repeat the same labels
+def _looks_like_label_cached(text):
+    """Label heuristics behind looks_like_label, for text of at most 100 characters.
+    
+    The cheapest discriminating checks (length, colon, URL prefix) run
+    first; the keyword and digit regexes only run on what's left.
+    """
     if not text or not isinstance(text, str):
         return False
     
     text = text.strip()
+    length = len(text)
+    
+    if length < 2 or length > 100:
+        return False
     
-    if len(text) < 2:
+    ends_with_colon = text.endswith(':')
+    if not ends_with_colon and length > 40:
         return False
     
-    text_lower = text.lower()
-    ends_with_colon = text.rstrip().endswith(':')
-    has_keyword = any(keyword in text_lower for keyword in LABEL_KEYWORDS)
+    if text[:4].lower().startswith(('http', 'www')):
+        return False
     
-    if not (ends_with_colon or has_keyword):
+    # text is already stripped; only search for keywords when there's no colon
+    if not ends_with_colon and not has_label_keyword(text):
         return False
     
     if ends_with_colon:
-        if len(text) > 100:
-            return False
-        if '@' in text and not any(kw in text_lower for kw in ['email', 'correo', 'mail']):
-            return False
-        if text_lower.startswith(('http', 'www')):
+        if '@' in text and not any(kw in text.lower() for kw in ['email', 'correo', 'mail']):
             return False
         return True
     
-    if len(text) > 40:
-        return False
-    
-    if re.search(r'\d+', text) and not text[0].isdigit() and not text[-1].isdigit():
-        return False
-    
-    if '@' in text and 'email' not in text_lower and 'correo' not in text_lower:
-        return False
+    if '@' in text:
+        text_lower = text.lower()
+        if 'email' not in text_lower and 'correo' not in text_lower:
+            return False
     
-    if text_lower.startswith(('http', 'www')):
+    if not text[0].isdigit() and not text[-1].isdigit() and DIGIT_RE.search(text):
         return False
     
-    if re.search(r'\d{3,}', text):
+    if LONG_DIGITS_RE.search(text):
         return False
     
     return True
 
 def detect_fields(wb):
-    """Detect form fields in the Excel workbook"""
+    """Detect form fields in the Excel workbook (works on read-only workbooks).
+    
+    Returns (fields, merged_map, writable_coords), where writable_coords maps
+    each field target to the coordinate of the cell that takes its value.
+    """
     ws = wb.active
     merged_map = {}
     
-    for r in ws.merged_cells.ranges:
-        merged_map[r.coord] = r.coord.split(":")[0]
+    for coord in get_merged_ranges(ws):
+        merged_map[coord] = coord.split(":")[0]
+    
+    merge_index = build_merge_index(merged_map)
+    top_left_cells = {coordinate_to_tuple(top_left) for top_left in merged_map.values()}
     
+    # Snapshot values once: random cell access re-parses the sheet in read-only mode
+    grid = read_grid(ws)
+    # Only a merged range's top-left cell holds its value; drop leftovers in
+    # the covered cells, which Excel neither shows nor keeps on save
+    covered_cells = [
+        (row_idx, col_idx)
+        for row_idx, col_idx in grid
+        if row_idx in merge_index
+        and (merged := find_merged_range(row_idx, col_idx, merge_index)) is not None
+        and (row_idx, col_idx) != (merged[2], merged[0])
+    ]
+    for cell in covered_cells:
+        del grid[cell]
+
     all_potential_fields = {}
-    seen_coordinates = set()
+    target_to_label = {}  # field cell top-left -> label mapped to it
+    writable_coords = {}
     
-    for row in ws.iter_rows():
-        for cell in row:
-            if not cell.value or not isinstance(cell.value, str):
-                continue
-            
-            if is_merged_cell_but_not_top_left(cell):
-                continue
-            
-            if is_top_left_of_merged(cell.coordinate, merged_map):
-                continue
-            
-            label = cell.value.strip()
-            
-            if not looks_like_label(label):
-                continue
-            
-            row_idx = cell.row
-            col_idx = cell.column
-            
-            if col_idx > 1:
-                try:
-                    left_cell = ws.cell(row=row_idx, column=col_idx - 1)
-                    left_value = get_cell_value(left_cell)
-                    if left_value and isinstance(left_value, str) and len(left_value.strip()) > 10:
-                        if not label.rstrip().endswith(':'):
-                            continue
-                except:
-                    pass
-            
-            target = find_field_cell(cell, merged_map, ws)
-            
-            if target is None:
+    # Filter the label cells in one batch pass over the grid, the neighbour
+    # probing below then only runs on the (few) cells that look like labels
+    label_cells = [
+        (row_idx, col_idx, value.strip())
+        for (row_idx, col_idx), value in grid.items()
+        if type(value) is str and (row_idx, col_idx) not in top_left_cells and looks_like_label(value)
+    ]
+    
+    for row_idx, col_idx, label in label_cells:
+        # Labels ending with ':' are kept whatever is to their left, so only probe the others
+        if col_idx > 1 and not label.endswith(':'):
+            left_value = grid.get((row_idx, col_idx - 1))
+            if isinstance(left_value, str) and len(left_value) > 10 and len(left_value.strip()) > 10:
                 continue
-            
-            if ":" in target:
-                target_top_left = target.split(":")[0]
+        
+        # find_field_cell only returns targets whose top-left cell is empty
+        target = find_field_cell(row_idx, col_idx, grid, merge_index)
+        
+        if target is None:
+            continue
+        
+        if ":" in target:
+            target_top_left = target.split(":")[0]
+        else:
+            target_top_left = target
+        
+        existing_label = target_to_label.get(target_top_left)
+        if existing_label is not None:
+            if label.endswith(':') and not existing_label.endswith(':'):
+                del all_potential_fields[existing_label]
+                del target_to_label[target_top_left]
             else:
-                target_top_left = target
-            
-            try:
-                if ":" in target:
-                    top_left = target.split(":")[0]
-                    field_cell = ws[top_left]
-                else:
-                    field_cell = ws[target]
-                
-                if not is_cell_empty(field_cell):
-                    continue
-            except Exception as e:
                 continue
-            
-            if target_top_left in seen_coordinates:
-                existing_label = None
-                for lbl, tgt in all_potential_fields.items():
-                    tgt_tl = tgt.split(":")[0] if ":" in tgt else tgt
-                    if tgt_tl == target_top_left:
-                        existing_label = lbl
-                        break
-                
-                if existing_label:
-                    if label.rstrip().endswith(':') and not existing_label.rstrip().endswith(':'):
-                        del all_potential_fields[existing_label]
-                    else:
-                        continue
-            
-            if label not in all_potential_fields:
-                all_potential_fields[label] = target
-                seen_coordinates.add(target_top_left)
+        
+        if label not in all_potential_fields:
+            all_potential_fields[label] = target
+            target_to_label[target_top_left] = label
+            if ":" not in target:
+                # A single cell inside an already filled merge writes to the merge's top-left
+                merged = find_merged_range(*coordinate_to_tuple(target), merge_index)
+                if merged is not None:
+                    target_top_left = merged[4]
+            writable_coords[target] = target_top_left
     
-    return all_potential_fields, merged_map
+    return all_potential_fields, merged_map, writable_coords
 
-def get_data_from_ai(field_labels, max_retries=3):
-    """Calls AI API to generate JSON data based on the field labels."""
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY environment variable is not set")
+def copy_upload_to_temp(fileobj):
+    """Stream an uploaded file into a temporary .xlsx file.
     
-    client = OpenAI(api_key=api_key)
+    Returns the path and a content hash, computed while copying.
+    """
+    fileobj.seek(0)
+    digest = hashlib.blake2b(digest_size=16)
+    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as tmp:
+        while chunk := fileobj.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            tmp.write(chunk)
+            if tmp.tell() > MAX_UPLOAD_SIZE:
+                break  # Rejected by save_upload, no need to copy the rest
+        return tmp.name, digest.digest()
+
+def is_xlsx_file(path):
+    """Cheap check that a file is a zip containing an Excel workbook"""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return "xl/workbook.xml" in archive.namelist()
+    except zipfile.BadZipFile:
+        return False
+
+async def save_upload(file):
+    """Validate an upload and stream it to a temporary file, returns (path, digest)"""
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail=f"File is too large (max {MAX_UPLOAD_SIZE // (1024 * 1024)} MB): {file.filename}")
     
-    field_list = ", ".join(field_labels)
-    prompt = f"""Generate realistic sample data for the following form fields: {field_list}
+    path, digest = await asyncio.to_thread(copy_upload_to_temp, file.file)
+    if os.path.getsize(path) > MAX_UPLOAD_SIZE:
+        remove_temp_file(path)
+        raise HTTPException(status_code=413, detail=f"File is too large (max {MAX_UPLOAD_SIZE // (1024 * 1024)} MB): {file.filename}")
+    if not await asyncio.to_thread(is_xlsx_file, path):
+        remove_temp_file(path)
+        raise HTTPException(status_code=400, detail=f"File is not a valid Excel workbook: {file.filename}")
+    return path, digest
 
-IMPORTANT: Return ONLY a complete, valid JSON object. The JSON must:
-1. Have each field name as a key (exactly as listed above)
-2. Have appropriate sample data as the value for each key
-3. Be complete and properly closed (all brackets and braces must be closed)
-4. Be valid JSON that can be parsed
+def iter_file_chunks(fileobj, chunk_size=64 * 1024):
+    """Yield a file's contents in chunks, closing the file when done"""
+    with fileobj:
+        while chunk := fileobj.read(chunk_size):
+            yield chunk
 
-Return ONLY the JSON object, no explanations, no markdown, no code blocks.
+def remove_temp_file(path):
+    """Delete a temporary upload, ignoring files that are already gone"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
-Example format:
-{{"Full Name": "John Doe", "Address": "123 Main St, City, Country", "DOB": "01-15-1990", "Gender": "Male"}}
-"""
+def detect_fields_from_file(path, digest=None):
+    """Detect form fields on a read-only (streaming) copy of the workbook.
+    
+    Results are cached by content hash when a digest is given, so
+    re-uploads of the same template skip parsing entirely.
+    """
+    if digest is not None:
+        with _detection_cache_lock:
+            cached = _detection_cache.get(digest)
+            if cached is not None:
+                _detection_cache.move_to_end(digest)
+        if cached is not None:
+            return tuple(dict(result) for result in cached)
+    
+    # keep_links=False: the scan never needs external link parts, so skip parsing them.
+    # No data_only: a formula cell without a cached value would read as empty and be
+    # reported as a field, while the fill pass (which sees the formula) skips it
+    wb = load_workbook(path, read_only=True, keep_links=False)
+    try:
+        detected = detect_fields(wb)
+    finally:
+        wb.close()
+    
+    if digest is not None:
+        with _detection_cache_lock:
+            _detection_cache[digest] = tuple(dict(result) for result in detected)
+            while len(_detection_cache) > DETECTION_CACHE_SIZE:
+                _detection_cache.popitem(last=False)
+    return detected
+
+def get_ai_client():
+    """Get the shared OpenAI client, created on first use from OPENAI_API_KEY"""
+    global _openai_client
+    if _openai_client is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY environment variable is not set")
+        _openai_client = AsyncOpenAI(api_key=api_key, timeout=60.0)
+    return _openai_client
+
+def build_ai_messages(field_labels):
+    """Build the chat messages asking the AI for sample data for the field labels"""
+    return [
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Generate realistic sample data for the following form fields: {', '.join(field_labels)}"}
+    ]
+
+def build_multi_file_ai_messages(labels_by_file):
+    """Build the chat messages asking for sample data for several files in one call"""
+    file_fields = json.dumps(labels_by_file, ensure_ascii=False)
+    return [
+        {"role": "system", "content": AI_MULTI_FILE_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Generate realistic sample data for the form fields of these files: {file_fields}"}
+    ]
+
+def estimate_tokens(field_labels):
+    """Estimate the completion tokens needed for the field labels (uncapped)"""
+    return len(field_labels) * 25 + 200
+
+def estimate_max_tokens(field_labels):
+    """Estimate the completion token budget for the field labels"""
+    return min(AI_MAX_TOKENS, estimate_tokens(field_labels))
+
+def group_files_for_ai(labels_by_file):
+    """Split {file_id: labels} into groups whose combined reply fits in AI_MAX_TOKENS.
+    
+    Files are kept in order; a file too large to share a call ends up alone.
+    """
+    groups = []
+    group, group_labels = {}, []
+    for file_id, field_labels in labels_by_file.items():
+        if group and estimate_tokens(group_labels + field_labels) > AI_MAX_TOKENS:
+            groups.append(group)
+            group, group_labels = {}, []
+        group[file_id] = field_labels
+        group_labels = group_labels + field_labels
+    if group:
+        groups.append(group)
+    return groups
+
+def parse_ai_response(ai_response):
+    """Parse the AI response as JSON.
+    
+    JSON mode guarantees a bare object; otherwise the first object in the
+    text is decoded, which skips code fences and trailing explanations.
+    """
+    try:
+        return orjson.loads(ai_response)
+    except json.JSONDecodeError:
+        start = ai_response.find("{")
+        if start == -1:
+            raise
+        data, _ = JSON_DECODER.raw_decode(ai_response, start)
+        return data
+
+def get_ai_cache_key(field_labels):
+    """Cache key for a set of field labels (sha256 of the sorted, deduplicated labels)"""
+    return hashlib.sha256("\n".join(sorted(set(field_labels))).encode("utf-8")).hexdigest()
+
+def get_cached_ai_data(key):
+    """Return a copy of the cached AI data for a cache key, or None"""
+    with _ai_cache_lock:
+        data = _ai_cache.get(key)
+        if data is not None:
+            _ai_cache.move_to_end(key)
+    return dict(data) if data is not None else None
+
+def cache_ai_data(key, data):
+    """Remember the AI data for a cache key, evicting the least recently used entries"""
+    if not isinstance(data, dict):
+        return
+    with _ai_cache_lock:
+        _ai_cache[key] = dict(data)
+        while len(_ai_cache) > AI_CACHE_SIZE:
+            _ai_cache.popitem(last=False)
+
+async def get_data_from_ai(field_labels, max_retries=3):
+    """Calls AI API to generate JSON data based on the field labels.
+    
+    Results are cached by field-label signature, so the same template
+    uploaded again doesn't pay for another OpenAI call, and concurrent
+    requests with the same signature share a single in-flight call.
+    """
+    cache_key = get_ai_cache_key(field_labels)
+    data = get_cached_ai_data(cache_key)
+    if data is not None:
+        return data
+    
+    task = _ai_inflight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(generate_ai_data(field_labels, cache_key, max_retries))
+        _ai_inflight[cache_key] = task
+        task.add_done_callback(lambda _: _ai_inflight.pop(cache_key, None))
+    # shield: one client disconnecting mustn't cancel the call the others are waiting on
+    return dict(await asyncio.shield(task))
+
+async def generate_ai_data(field_labels, cache_key, max_retries=3):
+    """Run the OpenAI call (with retries) for get_data_from_ai"""
+    client = get_ai_client()
+    messages = build_ai_messages(field_labels)
+    
+    estimated_tokens = estimate_max_tokens(field_labels)
+    
+    # Labels still missing from the data; a retry only asks for these
+    data = {}
+    pending = field_labels
     
     for attempt in range(max_retries):
         try:
-            estimated_tokens = max(2000, len(field_labels) * 80 + 1000)
-            
-            try:
-                response = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant that generates realistic sample data. Always return complete, valid JSON objects. Never return incomplete or truncated JSON. Ensure all field names from the user's list are included as keys."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.2,
-                    max_tokens=estimated_tokens,
-                    response_format={"type": "json_object"}
-                )
-            except Exception as json_mode_error:
-                response = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant that generates realistic sample data. Always return complete, valid JSON objects. Never return incomplete or truncated JSON. Ensure all field names from the user's list are included as keys."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.2,
-                    max_tokens=estimated_tokens
-                )
-            
-            ai_response = response.choices[0].message.content.strip()
+            async with _ai_semaphore:
+                try:
+                    response = await client.chat.completions.create(
+                        model=AI_MODEL,
+                        messages=messages,
+                        temperature=0.2,
+                        max_tokens=estimated_tokens,
+                        response_format={"type": "json_object"}
+                    )
+                except BadRequestError:
+                    # Only a rejected response_format is worth a second call without JSON mode
+                    response = await client.chat.completions.create(
+                        model=AI_MODEL,
+                        messages=messages,
+                        temperature=0.2,
+                        max_tokens=estimated_tokens
+                    )
             
-            if ai_response.startswith("```"):
-                parts = ai_response.split("```")
-                for part in parts:
-                    part = part.strip()
-                    if part.startswith("json"):
-                        part = part[4:].strip()
-                    if part.startswith("{") or part.startswith("["):
-                        ai_response = part
-                        break
-                else:
-                    ai_response = next((p.strip() for p in parts if p.strip() and not p.strip().startswith("json")), ai_response)
+            generated = parse_ai_response(response.choices[0].message.content)
+            if not isinstance(generated, dict):
+                raise ValueError("AI response is not a JSON object")
+            data.update(generated)
+            pending = [label for label in pending if label not in generated]
             
-            ai_response = ai_response.strip()
-            if not ai_response.endswith("}") and not ai_response.endswith("]"):
-                open_braces = ai_response.count("{") - ai_response.count("}")
-                open_brackets = ai_response.count("[") - ai_response.count("]")
-                
-                if open_braces > 0 or open_brackets > 0:
-                    ai_response += "}" * open_braces + "]" * open_brackets
+            if pending and attempt < max_retries - 1:
+                # Regenerate just the labels the model left out instead of the whole form
+                messages = build_ai_messages(pending)
+                estimated_tokens = estimate_max_tokens(pending)
+                continue
             
-            data = json.loads(ai_response)
+            if not pending:
+                cache_ai_data(cache_key, data)
             return data
             
         except json.JSONDecodeError as e:
@@ -309,55 +635,153 @@ Example format:
             raise ValueError(f"Failed to parse AI response as JSON after {max_retries} attempts: {e}")
         except Exception as e:
             if attempt < max_retries - 1:
+                await asyncio.sleep(2 ** attempt)  # Exponential backoff
                 continue
             raise
 
-def is_cell_in_range(cell_coord, merged_range, ws):
-    """Check if a cell coordinate is within a merged range"""
-    if ":" not in merged_range:
-        return cell_coord == merged_range
+async def get_data_for_group_from_ai(labels_by_file):
+    """Generate data for a group of files with a single AI call.
     
+    Returns the files the response fully covered; any failure (API error,
+    unparseable or truncated reply, missing labels) just leaves files out of
+    the result, for the per-file fallback.
+    """
+    client = get_ai_client()
+    all_labels = [label for labels in labels_by_file.values() for label in labels]
     try:
-        min_col, min_row, max_col, max_row = range_boundaries(merged_range)
-        cell = ws[cell_coord]
-        cell_col = cell.column
-        cell_row = cell.row
-        return min_col <= cell_col <= max_col and min_row <= cell_row <= max_row
-    except:
-        start, end = merged_range.split(":")
-        return cell_coord == start or (start <= cell_coord <= end)
-
-def get_writable_cell(target_coord, ws, merged_map):
+        async with _ai_semaphore:
+            response = await client.chat.completions.create(
+                model=AI_MODEL,
+                messages=build_multi_file_ai_messages(labels_by_file),
+                temperature=0.2,
+                max_tokens=estimate_max_tokens(all_labels),
+                response_format={"type": "json_object"}
+            )
+        data = parse_ai_response(response.choices[0].message.content)
+    except Exception:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {file_id: value for file_id, value in data.items()
+            if file_id in labels_by_file and isinstance(value, dict)
+            and all(label in value for label in labels_by_file[file_id])}
+
+async def get_data_for_many_from_ai(labels_by_file):
+    """Generate data for several files with as few AI calls as possible.
+    
+    Files are packed into groups whose combined reply fits the token cap,
+    one call per group; files missing from a group's response (or whose
+    call failed) fall back to one call per file.
+    """
+    groups = [group for group in group_files_for_ai(labels_by_file) if len(group) > 1]
+    results = {}
+    for covered in await asyncio.gather(*(get_data_for_group_from_ai(group) for group in groups)):
+        results.update(covered)
+    
+    missing = [file_id for file_id in labels_by_file if file_id not in results]
+    if missing:
+        fallback = await asyncio.gather(*(get_data_from_ai(labels_by_file[file_id]) for file_id in missing))
+        results.update(zip(missing, fallback))
+    return results
+
+def fill_workbook_file(path, fields, data, merged_map, writable_coords):
+    """Fill a workbook file and return the saved file contents"""
+    wb = load_workbook(path)
+    fill_excel(wb, fields, data, merged_map, writable_coords)
+    output = BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+def fill_workbook_to_spooled_file(path, fields, data, merged_map, writable_coords):
+    """Reopen a workbook in edit mode, fill it and save it to a spooled temp file.
+    
+    Runs as one worker-thread call so neither the fill nor the save blocks
+    the event loop. Returns (output, filled_count, skipped_count, errors)
+    with output rewound to the start.
+    """
+    wb = load_workbook(path)
+    filled_count, skipped_count, errors = fill_excel(wb, fields, data, merged_map, writable_coords)
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOLED_OUTPUT_MAX_SIZE)
+    wb.save(output)
+    output.seek(0)
+    return output, filled_count, skipped_count, errors
+
+def build_batch_request(custom_id, field_labels):
+    """Build one JSONL line of an OpenAI Batch API input file"""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": AI_MODEL,
+            "messages": build_ai_messages(field_labels),
+            "temperature": 0.2,
+            "max_tokens": estimate_max_tokens(field_labels),
+            "response_format": {"type": "json_object"}
+        }
+    }
+
+def parse_batch_output(output_text, manifest):
+    """Parse a Batch API output file into {custom_id: data}, errors as {custom_id: message}
+    
+    A malformed record only fails its own file, and records whose custom_id
+    isn't in the job manifest are ignored.
+    """
+    results = {}
+    errors = {}
+    for line_number, line in enumerate(output_text.splitlines(), 1):
+        if not line.strip():
+            continue
+        custom_id = f"line-{line_number}"
+        try:
+            record = orjson.loads(line)
+            custom_id = record["custom_id"]
+            if custom_id not in manifest:
+                continue
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                errors[custom_id] = str(record.get("error") or response.get("body"))
+                continue
+            data = parse_ai_response(response["body"]["choices"][0]["message"]["content"])
+            if not isinstance(data, dict):
+                raise ValueError("expected a JSON object")
+            results[custom_id] = data
+        except (KeyError, IndexError, TypeError, AttributeError, ValueError) as e:
+            # (json.JSONDecodeError is a ValueError)
+            errors[custom_id] = f"Failed to parse AI response: {e}"
+    return results, errors
+
+def fill_batch_outputs(job_dir, manifest, results):
+    """Fill every workbook of a batch job and zip the filled files"""
+    output = BytesIO()
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+        for custom_id, entry in manifest.items():
+            if custom_id not in results:
+                continue
+            wb = load_workbook(os.path.join(job_dir, f"{custom_id}.xlsx"))
+            fill_excel(wb, entry["fields"], results[custom_id], entry["merged_map"], entry["writable_coords"])
+            buffer = BytesIO()
+            wb.save(buffer)
+            archive.writestr(f"filled_{entry['filename']}", buffer.getvalue())
+    output.seek(0)
+    return output
+
+def get_writable_cell(target_coord, ws, merged_map, merge_index):
     """Get the actual writable cell for a target coordinate (handles merged cells)"""
     if ":" in target_coord:
-        top_left = target_coord.split(":")[0]
-        if target_coord in merged_map:
-            return ws[merged_map[target_coord]]
-        else:
-            for merged_range_obj in ws.merged_cells.ranges:
-                if merged_range_obj.coord == target_coord:
-                    return ws.cell(row=merged_range_obj.min_row, column=merged_range_obj.min_col)
-            return ws[top_left]
-    else:
-        cell = ws[target_coord]
-        if isinstance(cell, MergedCell):
-            for merged_range, top_left in merged_map.items():
-                if is_cell_in_range(target_coord, merged_range, ws):
-                    return ws[top_left]
-            for merged_range_obj in ws.merged_cells.ranges:
-                try:
-                    min_col, min_row, max_col, max_row = range_boundaries(merged_range_obj.coord)
-                    cell_col = cell.column
-                    cell_row = cell.row
-                    if min_col <= cell_col <= max_col and min_row <= cell_row <= max_row:
-                        return ws.cell(row=min_row, column=min_col)
-                except:
-                    continue
-        return cell
-
-def fill_excel(wb, fields, data, merged_map):
+        return ws[merged_map.get(target_coord, target_coord.split(":")[0])]
+    cell = ws[target_coord]
+    if isinstance(cell, MergedCell):
+        merged = find_merged_range(cell.row, cell.column, merge_index)
+        if merged is not None:
+            return ws[merged[4]]
+    return cell
+
+def fill_excel(wb, fields, data, merged_map, writable_coords=None):
     """Fill Excel workbook with generated data"""
     ws = wb.active
+    writable_coords = writable_coords or {}
+    merge_index = None
     filled_count = 0
     skipped_count = 0
     errors = []
@@ -372,18 +796,20 @@ def fill_excel(wb, fields, data, merged_map):
             value = data[label]
             
             if isinstance(value, (dict, list)):
-                value = json.dumps(value, ensure_ascii=False)
+                value = orjson.dumps(value).decode()
             elif value is None:
                 value = ""
             else:
                 value = str(value)
             
-            try:
-                cell = get_writable_cell(target, ws, merged_map)
-            except Exception as e:
-                errors.append(f"Error getting writable cell for '{label}' -> {target}: {e}")
-                skipped_count += 1
-                continue
+            writable_coord = writable_coords.get(target)
+            if writable_coord is not None:
+                cell = ws[writable_coord]
+            else:
+                # Fallback for targets that weren't resolved at detection time
+                if merge_index is None:
+                    merge_index = build_merge_index(merged_map)
+                cell = get_writable_cell(target, ws, merged_map, merge_index)
             
             if not is_cell_empty(cell):
                 skipped_count += 1
@@ -412,7 +838,10 @@ async def root():
         },
         "other_endpoints": {
             "/detect": "POST - Detect form fields in Excel file (returns field list)",
-            "/fill": "POST - Fill Excel file with AI-generated or custom data"
+            "/fill": "POST - Fill Excel file with AI-generated or custom data",
+            "/process_many": "POST - Fill several Excel files using a single AI call (returns a zip)",
+            "/process_batch": "POST - Submit several Excel files as one OpenAI batch job (returns batch_id)",
+            "/process_batch/{batch_id}": "GET - Batch job status, or a zip of the filled files once completed"
         }
     }
 
@@ -444,13 +873,10 @@ async def process_excel(file: UploadFile = File(...)):
     if not file.filename.endswith(('.xlsx', '.xls')):
         raise HTTPException(status_code=400, detail="File must be an Excel file (.xlsx or .xls)")
     
+    path, digest = await save_upload(file)
     try:
-        # Read uploaded file
-        contents = await file.read()
-        wb = load_workbook(BytesIO(contents))
-        
-        # Step 1: Detect fields
-        fields, merged_map = detect_fields(wb)
+        # Step 1: Detect fields (read-only pass)
+        fields, merged_map, writable_coords = await asyncio.to_thread(detect_fields_from_file, path, digest)
         
         if not fields:
             raise HTTPException(
@@ -460,18 +886,17 @@ async def process_excel(file: UploadFile = File(...)):
         
         # Step 2: Generate data using AI
         field_labels = list(fields.keys())
-        data = get_data_from_ai(field_labels)
+        data = await get_data_from_ai(field_labels)
         
-        # Step 3: Fill Excel with generated data
-        filled_count, skipped_count, errors = fill_excel(wb, fields, data, merged_map)
+        # Step 3: Reopen in edit mode, fill Excel with generated data and save it
+        output, filled_count, skipped_count, errors = await asyncio.to_thread(
+            fill_workbook_to_spooled_file, path, fields, data, merged_map, writable_coords
+        )
         
-        # Step 4: Save and return the filled file
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
+        # Step 4: Return the filled file
         
         return StreamingResponse(
-            output,
+            iter_file_chunks(output),
             media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             headers={
                 "Content-Disposition": f"attachment; filename=filled_{file.filename}",
@@ -484,6 +909,8 @@ async def process_excel(file: UploadFile = File(...)):
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
+    finally:
+        remove_temp_file(path)
 
 @app.post("/detect")
 async def detect_form_fields(file: UploadFile = File(...)):
@@ -491,10 +918,9 @@ async def detect_form_fields(file: UploadFile = File(...)):
     if not file.filename.endswith(('.xlsx', '.xls')):
         raise HTTPException(status_code=400, detail="File must be an Excel file (.xlsx or .xls)")
     
+    path, digest = await save_upload(file)
     try:
-        contents = await file.read()
-        wb = load_workbook(BytesIO(contents))
-        fields, merged_map = detect_fields(wb)
+        fields, merged_map, writable_coords = await asyncio.to_thread(detect_fields_from_file, path, digest)
         
         return {
             "filename": file.filename,
@@ -503,6 +929,8 @@ async def detect_form_fields(file: UploadFile = File(...)):
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
+    finally:
+        remove_temp_file(path)
 
 @app.post("/fill")
 async def fill_form(
@@ -520,10 +948,9 @@ async def fill_form(
     if not file.filename.endswith(('.xlsx', '.xls')):
         raise HTTPException(status_code=400, detail="File must be an Excel file (.xlsx or .xls)")
     
+    path, digest = await save_upload(file)
     try:
-        contents = await file.read()
-        wb = load_workbook(BytesIO(contents))
-        fields, merged_map = detect_fields(wb)
+        fields, merged_map, writable_coords = await asyncio.to_thread(detect_fields_from_file, path, digest)
         
         if not fields:
             raise HTTPException(status_code=400, detail="No form fields detected in the file")
@@ -531,29 +958,216 @@ async def fill_form(
         # Get data
         if use_ai:
             field_labels = list(fields.keys())
-            data = get_data_from_ai(field_labels)
+            data = await get_data_from_ai(field_labels)
         else:
             if not custom_data:
                 raise HTTPException(status_code=400, detail="custom_data required when use_ai is False")
-            data = json.loads(custom_data)
+            data = orjson.loads(custom_data)
         
-        # Fill Excel
-        filled_count, skipped_count, errors = fill_excel(wb, fields, data, merged_map)
+        # Fill Excel (reopened in edit mode) and save it
+        output, filled_count, skipped_count, errors = await asyncio.to_thread(
+            fill_workbook_to_spooled_file, path, fields, data, merged_map, writable_coords
+        )
+        
+        return StreamingResponse(
+            iter_file_chunks(output),
+            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            headers={"Content-Disposition": f"attachment; filename=filled_{file.filename}"}
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
+    finally:
+        remove_temp_file(path)
+
+@app.post("/process_many")
+async def process_many(files: List[UploadFile] = File(...)):
+    """
+    Fill several Excel files with AI-generated data using a single AI call.
+    
+    The fields of all files are sent in one prompt, which saves the per-call
+    overhead of one request per file. Returns a zip with the filled files.
+    """
+    for file in files:
+        if not file.filename.endswith(('.xlsx', '.xls')):
+            raise HTTPException(status_code=400, detail=f"File must be an Excel file (.xlsx or .xls): {file.filename}")
+    
+    paths = []
+    try:
+        uploads = {}
+        for index, file in enumerate(files):
+            path, digest = await save_upload(file)
+            paths.append(path)
+            fields, merged_map, writable_coords = await asyncio.to_thread(detect_fields_from_file, path, digest)
+            if fields:
+                uploads[f"file-{index}"] = (file.filename, path, fields, merged_map, writable_coords)
+        
+        if not uploads:
+            raise HTTPException(status_code=400, detail="No form fields detected in any of the files")
+        
+        labels_by_file = {file_id: list(upload[2].keys()) for file_id, upload in uploads.items()}
+        data = await get_data_for_many_from_ai(labels_by_file)
+        
+        filled_files = await asyncio.gather(*(
+            asyncio.to_thread(fill_workbook_file, path, fields, data[file_id], merged_map, writable_coords)
+            for file_id, (filename, path, fields, merged_map, writable_coords) in uploads.items()
+        ))
         
-        # Save to BytesIO
         output = BytesIO()
-        wb.save(output)
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+            for (filename, *_), filled in zip(uploads.values(), filled_files):
+                archive.writestr(f"filled_{filename}", filled)
         output.seek(0)
         
         return StreamingResponse(
             output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": f"attachment; filename=filled_{file.filename}"}
+            media_type="application/zip",
+            headers={
+                "Content-Disposition": "attachment; filename=filled_files.zip",
+                "X-Files-Filled": str(len(uploads)),
+                "X-Files-Skipped": str(len(files) - len(uploads))
+            }
         )
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing files: {str(e)}")
+    finally:
+        for path in paths:
+            remove_temp_file(path)
+
+@app.post("/process_batch")
+async def process_batch(files: List[UploadFile] = File(...)):
+    """
+    Submit several Excel files as a single OpenAI Batch API job.
+    
+    Batch jobs cost half as much as regular calls and complete within 24h.
+    Poll `GET /process_batch/{batch_id}` to download the filled files.
+    """
+    for file in files:
+        if not file.filename.endswith(('.xlsx', '.xls')):
+            raise HTTPException(status_code=400, detail=f"File must be an Excel file (.xlsx or .xls): {file.filename}")
+    
+    paths = []
+    try:
+        uploads = {}
+        manifest = {}
+        skipped = []
+        lines = []
+        for index, file in enumerate(files):
+            path, digest = await save_upload(file)
+            paths.append(path)
+            fields, merged_map, writable_coords = await asyncio.to_thread(detect_fields_from_file, path, digest)
+            if not fields:
+                skipped.append(file.filename)
+                continue
+            custom_id = f"file-{index}"
+            uploads[custom_id] = path
+            manifest[custom_id] = {
+                "filename": file.filename,
+                "fields": fields,
+                "merged_map": merged_map,
+                "writable_coords": writable_coords
+            }
+            lines.append(orjson.dumps(build_batch_request(custom_id, list(fields.keys()))))
+        
+        if not lines:
+            raise HTTPException(status_code=400, detail="No form fields detected in any of the files")
+        
+        client = get_ai_client()
+        batch_input = await client.files.create(
+            file=("batch_input.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        
+        # Keep the uploads until the batch completes
+        job_dir = os.path.join(BATCH_JOBS_DIR, batch.id)
+        os.makedirs(job_dir, exist_ok=True)
+        for custom_id, path in uploads.items():
+            shutil.move(path, os.path.join(job_dir, f"{custom_id}.xlsx"))
+        with open(os.path.join(job_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        
+        return {
+            "batch_id": batch.id,
+            "status": batch.status,
+            "files_submitted": len(manifest),
+            "files_skipped": skipped
+        }
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error submitting batch: {str(e)}")
+    finally:
+        for path in paths:
+            remove_temp_file(path)
+
+@app.get("/process_batch/{batch_id}")
+async def get_batch_result(batch_id: str):
+    """Return the batch job status, or a zip with the filled files once it has completed.
+    
+    The job directory is deleted once the batch reaches a terminal status
+    (after the zip is sent, for completed batches), so a completed batch
+    can be downloaded once; later requests get a 404.
+    """
+    job_dir = os.path.join(BATCH_JOBS_DIR, os.path.basename(batch_id))
+    manifest_path = os.path.join(job_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        raise HTTPException(status_code=404, detail=f"Unknown or already collected batch: {batch_id}")
+    
+    try:
+        client = get_ai_client()
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status not in BATCH_TERMINAL_STATUSES:
+            return {"batch_id": batch_id, "status": batch.status}
+        if batch.status != "completed" or not batch.output_file_id:
+            # Nothing to fill: the uploads aren't needed anymore
+            await asyncio.to_thread(shutil.rmtree, job_dir, True)
+            return {"batch_id": batch_id, "status": batch.status}
+        
+        # Claim the job (an atomic rename) so concurrent polls don't fill it twice
+        collect_dir = f"{job_dir}.collecting"
+        try:
+            os.rename(job_dir, collect_dir)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail=f"Unknown or already collected batch: {batch_id}")
+        
+        try:
+            with open(os.path.join(collect_dir, "manifest.json"), encoding="utf-8") as f:
+                manifest = json.load(f)
+            output_file = await client.files.content(batch.output_file_id)
+            results, errors = parse_batch_output(output_file.text, manifest)
+            output = await asyncio.to_thread(fill_batch_outputs, collect_dir, manifest, results)
+        except BaseException:
+            os.rename(collect_dir, job_dir)  # give the job back so a later poll can retry
+            raise
+        
+        return StreamingResponse(
+            output,
+            media_type="application/zip",
+            headers={
+                "Content-Disposition": f"attachment; filename=filled_{batch_id}.zip",
+                "X-Files-Filled": str(len(results)),
+                "X-Files-Failed": str(len(errors))
+            },
+            background=BackgroundTask(shutil.rmtree, collect_dir, ignore_errors=True)
+        )
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing batch: {str(e)}")
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,32 +1,27 @@
 from openpyxl import load_workbook
 from openpyxl.cell.cell import MergedCell
-from openpyxl.utils import range_boundaries, get_column_letter
+from openpyxl.utils import range_boundaries, get_column_letter, coordinate_to_tuple
+from xml.etree.ElementTree import iterparse
+import contextlib
+import hashlib
 import json
+import orjson
 import os
-import shutil
 import re
-from openai import OpenAI
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import lru_cache
+from openai import OpenAI, BadRequestError
 
-# Copy the template file first to preserve all formatting
-shutil.copy("sample.xlsx", "sample_output.xlsx")
-
-# Now open the copy and work with it
-wb = load_workbook("sample_output.xlsx")
-ws = wb.active
-
-merged_map = {}
-
-for r in ws.merged_cells.ranges:
-    merged_map[r.coord] = r.coord.split(":")[0]  # top-left cell
-
-print("Merged cells found:")
-print(f"Total merged ranges: {len(merged_map)}")
-for merged_range, top_left in merged_map.items():
-    print(f"  {merged_range} -> {top_left}")
-
-if not merged_map:
-    print("No merged cells found in the worksheet.")
+try:
+    import ahocorasick  # pyahocorasick, optional C extension for keyword matching
+except ImportError:
+    ahocorasick = None
 
+MERGE_CELL_TAG = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}mergeCell"
 
 # Spanish form field keywords commonly found in bank documents
 LABEL_KEYWORDS = [
@@ -41,195 +36,238 @@ LABEL_KEYWORDS = [
     'firma', 'fecha de', 'lugar de', 'hora', 'folio', 'referencia', 'número', 'numero'
 ]
 
-# Helper function to check if a cell is part of a merged range (but not the top-left)
-def is_merged_cell_but_not_top_left(cell):
-    """Check if cell is a MergedCell (not the writable top-left)"""
-    return isinstance(cell, MergedCell)
-
-# Helper function to check if a cell is the top-left of a merged range
-def is_top_left_of_merged(cell_coord, merged_map):
-    """Check if a cell coordinate is the top-left of any merged range"""
-    for merged_range, top_left in merged_map.items():
-        if cell_coord == top_left:
-            return True
-    return False
-
-# Helper function to get the cell value safely
-def get_cell_value(cell):
-    """Safely get cell value, handling MergedCell"""
-    if isinstance(cell, MergedCell):
+# Normalize the keywords once (lowercase, no duplicates)
+LABEL_KEYWORDS = frozenset(keyword.lower() for keyword in LABEL_KEYWORDS)
+
+# Build an Aho-Corasick automaton so all keywords are matched in a single pass over the label
+if ahocorasick is not None:
+    LABEL_KEYWORD_AUTOMATON = ahocorasick.Automaton()
+    for keyword in LABEL_KEYWORDS:
+        LABEL_KEYWORD_AUTOMATON.add_word(keyword, keyword)
+    LABEL_KEYWORD_AUTOMATON.make_automaton()
+else:
+    LABEL_KEYWORD_AUTOMATON = None
+
+# Without pyahocorasick, fall back to one precompiled alternation (single scan in C, case-insensitive).
+# Keywords containing a shorter keyword ('fecha de' -> 'fecha') can't change the result, so they're left out
+LABEL_KEYWORD_RE = re.compile(
+    "|".join(re.escape(keyword) for keyword in sorted(LABEL_KEYWORDS)
+             if not any(other != keyword and other in keyword for other in LABEL_KEYWORDS)),
+    re.IGNORECASE
+)
+
+# ```json ... ``` around the reply; the body stops at the closing fence or the end of a truncated reply
+MARKDOWN_FENCE_RE = re.compile(r'^```(?i:json)?\s*(.*?)\s*(?:```|\Z)', re.DOTALL)
+
+DIGIT_RE = re.compile(r'\d')  # existence test only, so match a single digit
+LONG_DIGITS_RE = re.compile(r'\d{3,}')
+
+AI_MODEL = "gpt-4.1-mini"
+AI_SYSTEM_PROMPT = "You generate realistic sample data for form fields. Reply with a single JSON object mapping every field id to its value."
+AI_MULTI_SYSTEM_PROMPT = "You generate realistic sample data for the fields of several forms. Reply with a single JSON object mapping every form id to an object that maps each of its field ids to a value."
+AI_MULTI_MAX_TOKENS = 8192  # completion budget of one call shared by several templates
+BATCH_POLL_INTERVAL = int(os.getenv("BATCH_POLL_INTERVAL", "30"))  # seconds between Batch API status checks
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+BATCH_MIN_TEMPLATES = 100  # multi-template runs this large go through the Batch API
+AI_MAX_WORKERS = 8  # concurrent chat calls for smaller multi-template runs
+
+# Created on first use and reused for every AI call in the process
+_openai_client = None
+
+# Generated data keyed by the (order-independent) set of field labels, so templates with
+# the same fields skip the AI call. Set AI_CACHE_FILE to persist it across runs.
+AI_CACHE_FILE = os.getenv("AI_CACHE_FILE")
+_ai_cache = None
+_ai_cache_lock = threading.Lock()
+
+
+# Helper function to check if a text contains any label keyword
+def has_label_keyword(text):
+    """Check if text contains any of the LABEL_KEYWORDS (case-insensitive)"""
+    if LABEL_KEYWORD_AUTOMATON is not None:
+        return next(LABEL_KEYWORD_AUTOMATON.iter(text.lower()), None) is not None
+    return LABEL_KEYWORD_RE.search(text) is not None
+
+# Helper function to read the merged ranges of a worksheet
+def read_merged_map(template_path, ws_ro):
+    """Map each merged range to its top-left cell.
+    Read-only worksheets don't expose merged cells, so stream the <mergeCell ref="..."/>
+    elements straight from the sheet XML inside the zip (only the coord strings are needed)."""
+    merged_map = {}
+    with zipfile.ZipFile(template_path) as archive, archive.open(ws_ro._worksheet_path) as src:
+        for _, element in iterparse(src, events=("end",)):
+            if element.tag == MERGE_CELL_TAG:
+                coord = element.get("ref")
+                merged_map[coord] = coord.split(":")[0]  # top-left cell
+            element.clear()
+    return merged_map
+
+# Helper function to index every cell of every merged range
+def build_merged_cell_index(merged_map):
+    """Index every cell of every merged range once: (row, col) -> (merged_range, (top_row, top_col))"""
+    merged_cell_index = {}
+    for merged_range in merged_map:
+        min_col, min_row, max_col, max_row = range_boundaries(merged_range)
+        top_left = (min_row, min_col)
+        for merged_row in range(min_row, max_row + 1):
+            for merged_col in range(min_col, max_col + 1):
+                merged_cell_index[(merged_row, merged_col)] = (merged_range, top_left)
+    return merged_cell_index
+
+# Helper function to get a value from the read-only rows snapshot
+def get_value_at(rows, row, column):
+    """Get a cell value from the rows snapshot, None if outside the used range"""
+    if row > len(rows):
         return None
-    return cell.value
+    values = rows[row - 1]
+    if column > len(values):
+        return None
+    return values[column - 1]
+
+# Helper function to check if a value is empty
+def is_value_empty(value):
+    """Check if a cell value is empty or contains only whitespace"""
+    # isspace() tests in place instead of allocating a stripped copy
+    return value is None or (type(value) is str and (not value or value.isspace()))
 
 # Helper function to check if a cell is empty
 def is_cell_empty(cell):
     """Check if a cell is empty or contains only whitespace"""
     if isinstance(cell, MergedCell):
         return True  # Merged cells (non-top-left) are considered empty
-    value = cell.value
-    return value is None or (isinstance(value, str) and value.strip() == "")
+    return is_value_empty(cell.value)
 
 # Helper function to find the field cell in multiple directions
-def find_field_cell(label_cell, merged_map):
-    """Find the field cell that's associated with a label cell.
-    Checks multiple directions: right (most common), below, and left."""
-    row_idx = label_cell.row
-    col_idx = label_cell.column
-    
-    # Skip if this cell is a MergedCell (not top-left)
-    if is_merged_cell_but_not_top_left(label_cell):
-        return None
+def probe_field_cell(field_row, field_col, rows, merged_cell_index):
+    """Return the field range/coordinate at (field_row, field_col) if it's empty, else None"""
+    # Check if field cell is part of a merged range
+    merged = merged_cell_index.get((field_row, field_col))
+    if merged is not None:
+        merged_range, top_left = merged
+        # Field cell is in this merged range, check if its top-left is empty
+        if is_value_empty(get_value_at(rows, *top_left)):
+            return merged_range
+        # Otherwise this merged range has data, fall back to the single cell check
     
-    # Skip if this cell is the top-left of a merged range (it's likely a field value, not a label)
-    if is_top_left_of_merged(label_cell.coordinate, merged_map):
-        return None
-    
-    # Try different directions in order of likelihood
-    directions = [
-        (0, 1),   # Right (most common)
-        (1, 0),   # Below
-        (0, -1),  # Left (less common, but sometimes labels are on the right)
-    ]
+    # Not merged, check single cell
+    if is_value_empty(get_value_at(rows, field_row, field_col)):
+        return f"{get_column_letter(field_col)}{field_row}"
+    return None
+
+def find_field_cell(row_idx, col_idx, rows, merged_cell_index):
+    """Find the field cell that's associated with the label at (row_idx, col_idx).
+    Checks multiple directions: right (most common), below, and left.
+    The A1 coordinate string is only built for the cell that is returned."""
+    # Right (most common)
+    field = probe_field_cell(row_idx, col_idx + 1, rows, merged_cell_index)
+    if field is not None:
+        return field
     
-    for row_offset, col_offset in directions:
-        field_row = row_idx + row_offset
-        field_col = col_idx + col_offset
-        
-        # Skip if out of bounds
-        if field_row < 1 or field_col < 1:
-            continue
-        
-        # Check if field cell is part of a merged range
-        for merged_range, top_left in merged_map.items():
-            try:
-                min_col, min_row, max_col, max_row = range_boundaries(merged_range)
-                if min_row <= field_row <= max_row and min_col <= field_col <= max_col:
-                    # Field cell is in this merged range
-                    # Check if the top-left of this merged range is empty
-                    top_left_cell = ws[top_left]
-                    if is_cell_empty(top_left_cell):
-                        return merged_range
-                    else:
-                        break  # This merged range has data, try next direction
-            except:
-                continue
-        
-        # Not merged, check single cell
-        try:
-            field_cell = ws.cell(row=field_row, column=field_col)
-            if is_cell_empty(field_cell):
-                return field_cell.coordinate
-        except:
-            pass
+    # Below
+    field = probe_field_cell(row_idx + 1, col_idx, rows, merged_cell_index)
+    if field is not None:
+        return field
     
+    # Left (less common, but sometimes labels are on the right); the only direction that can leave the sheet
+    if col_idx > 1:
+        return probe_field_cell(row_idx, col_idx - 1, rows, merged_cell_index)
     return None
 
 # Helper function to determine if text looks like a label (not a field value)
+@lru_cache(maxsize=4096)  # pure function of the text; templates repeat the same labels
 def looks_like_label(text):
-    """Determine if text looks like a form label rather than a field value"""
+    """Determine if text looks like a form label rather than a field value.
+    The cheapest discriminating checks run first; the regexes only run on what's left."""
     if not text or not isinstance(text, str):
         return False
     
     text = text.strip()
+    length = len(text)
     
-    # Too short
-    if len(text) < 2:
+    # Too short, or too long even for a label with a colon
+    if length < 2 or length > 100:
         return False
     
-    text_lower = text.lower()
+    ends_with_colon = text.endswith(':')
     
-    # Must end with colon OR contain form keywords
-    ends_with_colon = text.rstrip().endswith(':')
-    has_keyword = any(keyword in text_lower for keyword in LABEL_KEYWORDS)
+    # For labels without colons, apply stricter rules
+    # Labels are usually shorter
+    if not ends_with_colon and length > 40:
+        return False
+    
+    # If it starts with "http" or "www", it's a URL field value
+    if text[:4].lower().startswith(('http', 'www')):
+        return False
     
-    if not (ends_with_colon or has_keyword):
+    # Must end with colon OR contain form keywords
+    # (text is already stripped; only search for keywords when there's no colon)
+    if not ends_with_colon and not has_label_keyword(text):
         return False
     
     # If it ends with colon, it's very likely a label (but check a few edge cases)
     if ends_with_colon:
-        # Very long labels with colons are still labels, but check for obvious field values
-        if len(text) > 100:
-            return False
-        # If it looks like a URL or email with colon, skip
-        if '@' in text and not any(kw in text_lower for kw in ['email', 'correo', 'mail']):
-            return False
-        if text_lower.startswith(('http', 'www')):
+        # If it looks like an email with colon, skip
+        if '@' in text and not any(kw in text.lower() for kw in ['email', 'correo', 'mail']):
             return False
         return True
     
-    # For labels without colons, apply stricter rules
-    # Labels are usually shorter
-    if len(text) > 40:
-        return False
-    
     # Additional heuristics: labels are usually shorter and don't contain certain patterns
     # Field values often contain:
     # - Numbers in the middle (like addresses, phone numbers)
     # - Special characters like @, /, -, (
     # - Very long text
     
-    # If it has numbers in the middle (not just at start/end), it's likely a field value
-    if re.search(r'\d+', text) and not text[0].isdigit() and not text[-1].isdigit():
-        return False
-    
     # If it contains @, it's likely an email field value, not a label
-    if '@' in text and 'email' not in text_lower and 'correo' not in text_lower:
-        return False
+    if '@' in text:
+        text_lower = text.lower()
+        if 'email' not in text_lower and 'correo' not in text_lower:
+            return False
     
-    # If it starts with "http" or "www", it's a URL field value
-    if text_lower.startswith(('http', 'www')):
+    # If it has numbers in the middle (not just at start/end), it's likely a field value
+    if not text[0].isdigit() and not text[-1].isdigit() and DIGIT_RE.search(text):
         return False
     
     # If it contains common field value patterns (like phone numbers, addresses)
-    if re.search(r'\d{3,}', text):  # Long sequences of numbers
+    if LONG_DIGITS_RE.search(text):  # Long sequences of numbers
         return False
     
     return True
 
 # Collect all potential fields with improved detection
-all_potential_fields = {}
-seen_coordinates = set()  # Track which field cells we've already mapped
-
-print("\n=== SCANNING FOR FORM FIELDS ===")
-
-for row in ws.iter_rows():
-    for cell in row:
-        if not cell.value or not isinstance(cell.value, str):
-            continue
-        
-        # Skip if this cell is a MergedCell (not top-left)
-        if is_merged_cell_but_not_top_left(cell):
-            continue
-        
-        # Skip if this cell is the top-left of a merged range (likely a field value)
-        if is_top_left_of_merged(cell.coordinate, merged_map):
-            continue
-        
-        label = cell.value.strip()
-        
-        # Check if this looks like a label
-        if not looks_like_label(label):
-            continue
-        
-        row_idx = cell.row
-        col_idx = cell.column
-        
+def detect_fields(rows, merged_cell_index):
+    """Scan the rows snapshot for label -> field cell mappings"""
+    all_potential_fields = {}
+    target_to_label = {}  # Track which field cells we've already mapped (top-left -> label)
+    
+    # (row, col) of every merged range's top-left cell, reusing the boundaries the
+    # index already parsed instead of parsing the top-left strings again
+    merged_top_left_cells = {top_left for _, top_left in merged_cell_index.values()}
+    
+    # Per-cell pass as one comprehension: keep the non-empty strings that look like
+    # labels and don't sit on a merged top-left. Labels are non-empty strings, so rows
+    # with no truthy value (blank rows in the styled area) are skipped with one any().
+    label_cells = [
+        (row_idx, col_idx, value.strip())
+        for row_idx, row in enumerate(rows, start=1) if any(row)
+        for col_idx, value in enumerate(row, start=1)
+        if value and type(value) is str and looks_like_label(value)
+        and (row_idx, col_idx) not in merged_top_left_cells
+    ]
+    
+    # The per-label work below only runs on the (few) label candidates
+    for row_idx, col_idx, label in label_cells:
         # Additional check: If there's significant text to the left, this might be a field value
         # Labels are usually in the leftmost columns or have empty cells to their left
-        if col_idx > 1:  # Not in first column
-            try:
-                left_cell = ws.cell(row=row_idx, column=col_idx - 1)
-                left_value = get_cell_value(left_cell)
-                # If left cell has substantial text, current cell might be a field value
-                if left_value and isinstance(left_value, str) and len(left_value.strip()) > 10:
-                    # But if current cell ends with colon, it's still likely a label
-                    if not label.rstrip().endswith(':'):
-                        continue
-            except:
-                pass
+        # (if current cell ends with colon, it's still likely a label, so only probe the others)
+        if col_idx > 1 and not label.endswith(':'):  # Not in first column
+            left_value = rows[row_idx - 1][col_idx - 2]  # same row of the snapshot, no bounds check needed
+            # If left cell has substantial text, current cell might be a field value
+            # (the raw length bounds the stripped one, so strip only when it could pass)
+            if isinstance(left_value, str) and len(left_value) > 10 and len(left_value.strip()) > 10:
+                continue
         
-        # Find the field cell (checks multiple directions)
-        target = find_field_cell(cell, merged_map)
+        # Find the field cell (checks multiple directions); a returned cell's top-left is always empty
+        target = find_field_cell(row_idx, col_idx, rows, merged_cell_index)
         
         if target is None:
             continue  # No valid field cell found
@@ -240,170 +278,271 @@ for row in ws.iter_rows():
         else:
             target_top_left = target
         
-        # Verify the field cell is actually empty
-        try:
-            if ":" in target:
-                top_left = target.split(":")[0]
-                field_cell = ws[top_left]
-            else:
-                field_cell = ws[target]
-            
-            if not is_cell_empty(field_cell):
-                continue  # Field already has data
-        except Exception as e:
-            continue  # Skip if we can't verify
-        
         # Check for duplicate field cells
-        if target_top_left in seen_coordinates:
+        existing_label = target_to_label.get(target_top_left)
+        if existing_label is not None:
             # This field cell is already mapped
             # Only replace if the new label is more specific (ends with colon)
-            existing_label = None
-            for lbl, tgt in all_potential_fields.items():
-                tgt_tl = tgt.split(":")[0] if ":" in tgt else tgt
-                if tgt_tl == target_top_left:
-                    existing_label = lbl
-                    break
-            
-            if existing_label:
-                # If new label ends with colon and old one doesn't, replace
-                if label.rstrip().endswith(':') and not existing_label.rstrip().endswith(':'):
-                    del all_potential_fields[existing_label]
-                else:
-                    continue  # Keep existing mapping
+            if label.endswith(':') and not existing_label.endswith(':'):
+                del all_potential_fields[existing_label]
+                del target_to_label[target_top_left]
+            else:
+                continue  # Keep existing mapping
         
         # All checks passed - this is a valid label -> field mapping
         # Use the first occurrence if duplicate labels exist
         if label not in all_potential_fields:
             all_potential_fields[label] = target
-            seen_coordinates.add(target_top_left)
+            target_to_label[target_top_left] = label
+    
+    return all_potential_fields
+
+
+def get_ai_client():
+    """Get the shared OpenAI client (requires OPENAI_API_KEY environment variable)"""
+    global _openai_client
+    if _openai_client is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY environment variable is not set. Please set it to use AI data generation.")
+        _openai_client = OpenAI(api_key=api_key)
+    return _openai_client
+
+
+def build_field_ids(field_labels):
+    """Map short ids ("f0".."fN") to field labels so the model doesn't echo long labels as keys"""
+    return {f"f{i}": label for i, label in enumerate(field_labels)}
 
-print("\n=== FIELD DETECTION ANALYSIS ===")
-print(f"Total potential fields found (after improved filtering): {len(all_potential_fields)}")
 
-# Final fields dictionary (already filtered)
-fields = all_potential_fields
+def build_ai_prompt(id_to_label):
+    """Build the user prompt describing each field id"""
+    return f"Generate realistic sample data for these form fields (id: description): {json.dumps(id_to_label, ensure_ascii=False)}"
 
-print(f"Total fields found: {len(fields)}")
 
-print("\nDetected fields (label -> field cell):")
-for label, target in fields.items():
-    print(f"  '{label}' -> {target}")
+def remap_ai_data(raw, id_to_label):
+    """Map the model's {id: value} answer back to {label: value}"""
+    return {id_to_label[key]: value for key, value in raw.items() if key in id_to_label}
 
-if not fields:
-    print("No fields found in the worksheet after filtering.")
+
+def estimate_max_tokens(field_labels):
+    """Estimate: ~40 tokens per value (keys are short ids) + buffer for structure"""
+    return max(1000, len(field_labels) * 40 + 500)
+
+
+def build_ai_request_body(id_to_label, max_tokens, json_mode=True):
+    """Build the chat completions request body (shared by the sync and Batch API paths)"""
+    body = {
+        "model": AI_MODEL,
+        "messages": [
+            {"role": "system", "content": AI_SYSTEM_PROMPT},
+            {"role": "user", "content": build_ai_prompt(id_to_label)}
+        ],
+        "temperature": 0.2,
+        "max_tokens": max_tokens,
+    }
+    if json_mode:
+        body["response_format"] = {"type": "json_object"}  # Force JSON mode
+    return body
+
+
+def build_multi_ai_request_body(ids_by_form, max_tokens):
+    """Build one chat completions request body covering several forms ({form id: {field id: label}})"""
+    return {
+        "model": AI_MODEL,
+        "messages": [
+            {"role": "system", "content": AI_MULTI_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Generate realistic sample data for the fields of these forms (form id: field id: description): {json.dumps(ids_by_form, ensure_ascii=False)}"}
+        ],
+        "temperature": 0.2,
+        "max_tokens": max_tokens,
+        "response_format": {"type": "json_object"},
+    }
+
+
+def group_templates_for_ai(labels_by_template):
+    """Split {template: field_labels} into groups whose combined reply fits in AI_MULTI_MAX_TOKENS.
+    Templates keep their order; one too large to share a call ends up alone."""
+    groups = []
+    group, group_labels = {}, []
+    for template, field_labels in labels_by_template.items():
+        if group and estimate_max_tokens(group_labels + field_labels) > AI_MULTI_MAX_TOKENS:
+            groups.append(group)
+            group, group_labels = {}, []
+        group[template] = field_labels
+        group_labels = group_labels + field_labels
+    if group:
+        groups.append(group)
+    return groups
+
+
+def parse_ai_response(ai_response, repair=False):
+    """Parse the AI response as JSON.
+    JSON mode returns a bare object, so the happy path is a single orjson.loads;
+    markdown fences are only stripped when that fails. Truncated JSON is closed
+    only with repair=True, the result is then partial at best."""
+    try:
+        return orjson.loads(ai_response)
+    except orjson.JSONDecodeError:
+        pass
+    
+    ai_response = ai_response.strip()
+    
+    # Remove markdown code blocks if present (the closing fence may be cut off)
+    fence = MARKDOWN_FENCE_RE.match(ai_response)
+    if fence:
+        ai_response = fence.group(1)
+    
+    try:
+        return orjson.loads(ai_response)
+    except orjson.JSONDecodeError:
+        if not repair:
+            raise
+    
+    # Still invalid: most likely truncated by max_tokens, try to close it
+    print(f"Warning: JSON appears incomplete. Attempting to fix...")
+    return orjson.loads(close_truncated_json(ai_response))
+
+
+def close_truncated_json(text):
+    """Close the string, arrays and objects left open by a truncated JSON text.
+    One string-aware pass, so braces inside values don't count and the closers
+    come out in the right order (the old brace counting got both wrong)."""
+    closers = []
+    in_string = False
+    escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            closers.append("}")
+        elif ch == "[":
+            closers.append("]")
+        elif ch in "}]" and closers:
+            closers.pop()
+    
+    if in_string:
+        if escaped:
+            text = text[:-1]  # cut in the middle of an escape sequence
+        text += '"'
+    # A trailing comma (cut right after a complete value) can't precede a closer
+    text = text.rstrip()
+    if text.endswith(","):
+        text = text[:-1]
+    return text + "".join(reversed(closers))
+
+
+def get_ai_cache_key(field_labels):
+    """Cache key for a set of field labels (sha256 of the sorted, deduplicated labels)"""
+    return hashlib.sha256("\n".join(sorted(set(field_labels))).encode("utf-8")).hexdigest()
+
+
+def get_cached_ai_data(field_labels):
+    """Return cached data for these field labels, or None"""
+    global _ai_cache
+    with _ai_cache_lock:
+        if _ai_cache is None:
+            _ai_cache = {}
+            if AI_CACHE_FILE and os.path.exists(AI_CACHE_FILE):
+                with open(AI_CACHE_FILE, "rb") as f:
+                    _ai_cache = orjson.loads(f.read())
+        data = _ai_cache.get(get_ai_cache_key(field_labels))
+    return dict(data) if data is not None else None
+
+
+def cache_ai_data(field_labels, data):
+    """Remember the data generated for these field labels (and persist it if AI_CACHE_FILE is set).
+    Only complete answers are kept, a partial one would be reused for every later run."""
+    if any(label not in data for label in field_labels):
+        return
+    with _ai_cache_lock:
+        if _ai_cache is None:
+            return
+        _ai_cache[get_ai_cache_key(field_labels)] = data
+        if AI_CACHE_FILE:
+            # Write a temp file and swap it in, so an interrupted write never leaves a corrupt cache
+            temp_path = f"{AI_CACHE_FILE}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(orjson.dumps(_ai_cache))
+            os.replace(temp_path, AI_CACHE_FILE)
 
 
 def get_data_from_ai(field_labels, max_retries=3):
     """
     Calls AI API to generate JSON data based on the field labels.
     Returns a dictionary with field labels as keys and generated values.
+    Synchronous path, used for single-file interactive runs.
     """
-    # Initialize OpenAI client (requires OPENAI_API_KEY environment variable)
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY environment variable is not set. Please set it to use AI data generation.")
+    data = get_cached_ai_data(field_labels)
+    if data is not None:
+        print(f"\nUsing cached AI data for {len(field_labels)} fields")
+        return data
     
-    client = OpenAI(api_key=api_key)
-    
-    # Create prompt for AI - be more explicit about JSON format
-    field_list = ", ".join(field_labels)
-    prompt = f"""Generate realistic sample data for the following form fields: {field_list}
-
-IMPORTANT: Return ONLY a complete, valid JSON object. The JSON must:
-1. Have each field name as a key (exactly as listed above)
-2. Have appropriate sample data as the value for each key
-3. Be complete and properly closed (all brackets and braces must be closed)
-4. Be valid JSON that can be parsed
-
-Return ONLY the JSON object, no explanations, no markdown, no code blocks.
-
-Example format:
-{{"Full Name": "John Doe", "Address": "123 Main St, City, Country", "DOB": "01-15-1990", "Gender": "Male"}}
-"""
+    client = get_ai_client()
+    id_to_label = build_field_ids(field_labels)
     
     print("\nCalling AI to generate data...")
-    print(f"Fields sent to AI: {field_list}")
+    print(f"Fields sent to AI: {', '.join(field_labels)}")
     print(f"Total fields: {len(field_labels)}")
     
+    # Calculate appropriate max_tokens based on number of fields
+    estimated_tokens = estimate_max_tokens(field_labels)
+    
     for attempt in range(max_retries):
+        ai_response = ""
         try:
-            # Calculate appropriate max_tokens based on number of fields
-            # Estimate: ~50-100 tokens per field + buffer for structure
-            estimated_tokens = max(2000, len(field_labels) * 80 + 1000)
             print(f"Using max_tokens: {estimated_tokens} (attempt {attempt + 1}/{max_retries})")
             
-            # Try with JSON mode first, fallback if not supported
+            # Try with JSON mode first, fallback if the model rejects it (a 400, not a network error)
             try:
-                response = client.chat.completions.create(
-                    model="gpt-4.1-mini",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant that generates realistic sample data. Always return complete, valid JSON objects. Never return incomplete or truncated JSON. Ensure all field names from the user's list are included as keys."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.2,
-                    max_tokens=estimated_tokens,
-                    response_format={"type": "json_object"}  # Force JSON mode
-                )
-            except Exception as json_mode_error:
+                response = client.chat.completions.create(**build_ai_request_body(id_to_label, estimated_tokens))
+            except BadRequestError as json_mode_error:
                 # If JSON mode not supported, try without it
                 print(f"JSON mode not supported, trying without it: {json_mode_error}")
-                response = client.chat.completions.create(
-                    model="gpt-4.1-mini",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant that generates realistic sample data. Always return complete, valid JSON objects. Never return incomplete or truncated JSON. Ensure all field names from the user's list are included as keys."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.2,
-                    max_tokens=estimated_tokens
-                )
+                response = client.chat.completions.create(**build_ai_request_body(id_to_label, estimated_tokens, json_mode=False))
             
             # Extract JSON from response
-            ai_response = response.choices[0].message.content.strip()
-            
-            # Remove markdown code blocks if present
-            if ai_response.startswith("```"):
-                parts = ai_response.split("```")
-                # Find the JSON part (usually the middle part)
-                for part in parts:
-                    part = part.strip()
-                    if part.startswith("json"):
-                        part = part[4:].strip()
-                    if part.startswith("{") or part.startswith("["):
-                        ai_response = part
-                        break
-                else:
-                    # If no JSON found, try the first non-empty part
-                    ai_response = next((p.strip() for p in parts if p.strip() and not p.strip().startswith("json")), ai_response)
+            choice = response.choices[0]
+            ai_response = choice.message.content or ""
+            truncated = choice.finish_reason == "length"
+            if not truncated:
+                try:
+                    raw = parse_ai_response(ai_response)
+                except json.JSONDecodeError as e:
+                    print(f"Error parsing AI response as JSON (attempt {attempt + 1}/{max_retries}): {e}")
+                    truncated = True
+            else:
+                print(f"AI response cut off at max_tokens (attempt {attempt + 1}/{max_retries})")
             
-            # Try to fix incomplete JSON if needed
-            ai_response = ai_response.strip()
-            if not ai_response.endswith("}") and not ai_response.endswith("]"):
-                # Try to find and close incomplete JSON
-                open_braces = ai_response.count("{") - ai_response.count("}")
-                open_brackets = ai_response.count("[") - ai_response.count("]")
-                
-                if open_braces > 0 or open_brackets > 0:
-                    print(f"Warning: JSON appears incomplete. Attempting to fix...")
-                    # Close any open structures
-                    ai_response += "}" * open_braces + "]" * open_brackets
+            if truncated:
+                if attempt < max_retries - 1:
+                    print(f"Retrying with increased token limit...")
+                    # Increase tokens on retry
+                    estimated_tokens = int(estimated_tokens * 1.5)
+                    continue
+                # Out of retries: keep what the truncated reply holds, as a partial answer (never cached)
+                try:
+                    data = remap_ai_data(parse_ai_response(ai_response, repair=True), id_to_label)
+                except json.JSONDecodeError as e:
+                    print(f"Raw AI response (last 500 chars): {ai_response[-500:]}")
+                    raise ValueError(f"Failed to parse AI response as JSON after {max_retries} attempts. The response may be incomplete. Last error: {e}")
+                print(f"Warning: AI response still incomplete after {max_retries} attempts, "
+                      f"using the {len(data)}/{len(id_to_label)} fields recovered from it")
+                return data
             
-            # Parse JSON
-            data = json.loads(ai_response)
+            data = remap_ai_data(raw, id_to_label)
             
             print(f"AI Response received successfully: {len(data)} fields")
             print(f"AI Response preview (first 3 fields): {json.dumps(dict(list(data.items())[:3]), indent=2)}...")
+            cache_ai_data(field_labels, data)
             return data
             
-        except json.JSONDecodeError as e:
-            print(f"Error parsing AI response as JSON (attempt {attempt + 1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                print(f"Retrying with increased token limit...")
-                # Increase tokens on retry
-                estimated_tokens = int(estimated_tokens * 1.5)
-                continue
-            else:
-                print(f"Raw AI response (last 500 chars): {ai_response[-500:]}")
-                raise ValueError(f"Failed to parse AI response as JSON after {max_retries} attempts. The response may be incomplete. Last error: {e}")
         except Exception as e:
             print(f"Error calling AI API (attempt {attempt + 1}/{max_retries}): {e}")
             if attempt < max_retries - 1:
@@ -412,75 +551,153 @@ Example format:
             raise
 
 
-# Get field labels (keys from fields dictionary)
-field_labels = list(fields.keys())
+def get_group_data_from_ai(labels_by_template):
+    """
+    Generates data for several templates with a single chat completion.
+    Returns {template: data} for the templates the reply fully covered; the others
+    (or all of them, if the call fails) are left for the per-template fallback.
+    """
+    forms = {f"t{i}": (template, build_field_ids(field_labels))
+             for i, (template, field_labels) in enumerate(labels_by_template.items())}
+    all_labels = [label for field_labels in labels_by_template.values() for label in field_labels]
+    
+    print(f"\nCalling AI for {len(forms)} templates in one request ({len(all_labels)} fields)...")
+    try:
+        body = build_multi_ai_request_body({form_id: id_to_label for form_id, (_, id_to_label) in forms.items()},
+                                           estimate_max_tokens(all_labels))
+        response = get_ai_client().chat.completions.create(**body)
+        raw = parse_ai_response(response.choices[0].message.content)
+    except Exception as e:
+        print(f"Combined AI call failed, falling back to one call per template: {e}")
+        return {}
+    if not isinstance(raw, dict):
+        return {}
+    
+    results = {}
+    for form_id, (template, id_to_label) in forms.items():
+        values = raw.get(form_id)
+        if not isinstance(values, dict):
+            continue
+        data = remap_ai_data(values, id_to_label)
+        if len(data) == len(id_to_label):  # partial answers go through the single call and its retries
+            cache_ai_data(labels_by_template[template], data)
+            results[template] = data
+    return results
 
-if field_labels:
-    # Call AI to get dynamic data
-    data = get_data_from_ai(field_labels)
+
+def get_data_for_many_from_ai(labels_by_template):
+    """
+    Generates data for several templates with as few chat completions as possible:
+    cached label sets are reused, the rest are packed into calls that fit
+    AI_MULTI_MAX_TOKENS, and templates missing from a combined reply fall back to
+    get_data_from_ai. Takes {template: field_labels} and returns {template: data}.
+    """
+    results = {}
+    pending = {}
+    for template, field_labels in labels_by_template.items():
+        data = get_cached_ai_data(field_labels)
+        if data is not None:
+            results[template] = data
+        else:
+            pending[template] = field_labels
     
-    print("\nFilling Excel with AI-generated data...")
+    groups = [group for group in group_templates_for_ai(pending) if len(group) > 1]
+    get_ai_client()  # create the shared client before the worker threads use it
+    with ThreadPoolExecutor(max_workers=AI_MAX_WORKERS) as ai_pool:
+        for covered in ai_pool.map(get_group_data_from_ai, groups):
+            results.update(covered)
+        missing = [template for template in pending if template not in results]
+        results.update(zip(missing, ai_pool.map(get_data_from_ai, [pending[template] for template in missing])))
+    return results
+
+
+def get_data_from_ai_batch(labels_by_template, poll_interval=BATCH_POLL_INTERVAL):
+    """
+    Generates data for many templates in a single OpenAI Batch API job (50% cheaper,
+    separate rate limits, up to 24h turnaround).
+    Takes {template_name: field_labels} and returns {template_name: data}.
+    """
+    client = get_ai_client()
     
-    # Helper function to check if a cell coordinate is within a merged range
-    def is_cell_in_range(cell_coord, merged_range):
-        """Check if a cell coordinate is within a merged range"""
-        if ":" not in merged_range:
-            return cell_coord == merged_range
-        
-        start, end = merged_range.split(":")
+    # One JSONL line per template, keyed by the template name
+    lines = []
+    ids_by_template = {}
+    for template_name, field_labels in labels_by_template.items():
+        ids_by_template[template_name] = build_field_ids(field_labels)
+        lines.append(json.dumps({
+            "custom_id": template_name,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_ai_request_body(ids_by_template[template_name], estimate_max_tokens(field_labels)),
+        }))
+    
+    batch_input = client.files.create(file=("batch_input.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"\nSubmitted batch {batch.id} with {len(lines)} request(s)")
+    
+    while batch.status not in BATCH_TERMINAL_STATUSES:
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+        print(f"Batch {batch.id} status: {batch.status}")
+    
+    if batch.status != "completed" or not batch.output_file_id:
+        raise ValueError(f"Batch {batch.id} finished with status '{batch.status}'")
+    
+    # Index the results by custom_id (output order is not guaranteed)
+    results = {}
+    for line in client.files.content(batch.output_file_id).content.splitlines():
+        if not line.strip():
+            continue
+        # A bad record only drops its own template, which then takes the per-template path
+        custom_id = None
         try:
-            min_col, min_row, max_col, max_row = range_boundaries(merged_range)
-            cell_col = ws[cell_coord].column
-            cell_row = ws[cell_coord].row
-            return min_col <= cell_col <= max_col and min_row <= cell_row <= max_row
-        except:
-            # Fallback: simple string check
-            return cell_coord == start or (start <= cell_coord <= end)
-    
-    # Helper function to get the writable cell for a target (handles merged cells)
-    def get_writable_cell(target_coord):
-        """Get the actual writable cell for a target coordinate (handles merged cells)"""
-        if ":" in target_coord:
-            # This is a merged range
-            top_left = target_coord.split(":")[0]
-            # Check if it's in merged_map
-            if target_coord in merged_map:
-                return ws[merged_map[target_coord]]
-            else:
-                # Try to find it in merged_cells
-                for merged_range_obj in ws.merged_cells.ranges:
-                    if merged_range_obj.coord == target_coord:
-                        return ws.cell(row=merged_range_obj.min_row, column=merged_range_obj.min_col)
-                # Fallback to top-left
-                return ws[top_left]
-        else:
-            # Single cell
-            cell = ws[target_coord]
-            # If it's a MergedCell, find the top-left
-            if isinstance(cell, MergedCell):
-                for merged_range, top_left in merged_map.items():
-                    if is_cell_in_range(target_coord, merged_range):
-                        return ws[top_left]
-                # If we can't find it, try merged_cells directly
-                for merged_range_obj in ws.merged_cells.ranges:
-                    try:
-                        min_col, min_row, max_col, max_row = range_boundaries(merged_range_obj.coord)
-                        cell_col = ws[target_coord].column
-                        cell_row = ws[target_coord].row
-                        if min_col <= cell_col <= max_col and min_row <= cell_row <= max_row:
-                            return ws.cell(row=min_row, column=min_col)
-                    except:
-                        continue
-            return cell
-    
-    # Fill Excel with the AI-generated data
+            record = orjson.loads(line)  # parse the raw bytes, no decode step
+            custom_id = record.get("custom_id")
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                print(f"Batch request for '{custom_id}' failed: {record.get('error')}")
+                continue
+            id_to_label = ids_by_template.get(custom_id)
+            if id_to_label is None:
+                continue
+            content = response["body"]["choices"][0]["message"]["content"]
+            results[custom_id] = remap_ai_data(parse_ai_response(content), id_to_label)
+        except (KeyError, IndexError, TypeError, AttributeError, ValueError) as e:
+            print(f"Batch output for '{custom_id}' could not be parsed, skipped: {e}")
+    
+    return results
+
+
+# Helper function to get the writable cell for a target (handles merged cells)
+def build_writable_cells(fields, merged_cell_index):
+    """Map each field target to the (row, col) of the cell a value is written to,
+    resolved once at scan time so the fill loop doesn't need the merge index."""
+    # A merged range target writes to its own top-left, which the index maps to itself;
+    # a single cell inside a merged range writes to that range's top-left
+    writable_cells = {}
+    for target in fields.values():
+        position = coordinate_to_tuple(target.split(":")[0])
+        merged = merged_cell_index.get(position)
+        writable_cells[target] = merged[1] if merged is not None else position
+    return writable_cells
+
+
+def fill_fields(ws, fields, data, writable_cells):
+    """Fill Excel with the AI-generated data, returns (filled_count, skipped_count)"""
     filled_count = 0
     skipped_count = 0
+    # Per-field messages are buffered and written to stdout once at the end
+    log_lines = []
+    log = log_lines.append
     
     for label, target in fields.items():
         try:
             if label not in data:
-                print(f"  Warning: '{label}' not found in AI response data")
+                log(f"  Warning: '{label}' not found in AI response data")
                 skipped_count += 1
                 continue
             
@@ -496,37 +713,236 @@ if field_labels:
                 # Convert to string
                 value = str(value)
             
-            # Get the writable cell
-            try:
-                cell = get_writable_cell(target)
-            except Exception as e:
-                print(f"  Error getting writable cell for '{label}' -> {target}: {e}")
-                skipped_count += 1
-                continue
+            # Get the writable cell (resolved at scan time)
+            cell = ws.cell(*writable_cells[target])
             
             # Verify the cell is still empty (double-check)
             if not is_cell_empty(cell):
-                print(f"  Skipped '{label}' -> {cell.coordinate} (cell already has data: '{str(cell.value)[:30]}...')")
+                log(f"  Skipped '{label}' -> {cell.coordinate} (cell already has data: '{str(cell.value)[:30]}...')")
                 skipped_count += 1
                 continue
             
             # Set the value on the writable cell
             cell.value = value
             filled_count += 1
-            print(f"  ✓ Filled '{label}' -> {cell.coordinate} ({target}) with: {str(value)[:50]}...")
+            log(f"  ✓ Filled '{label}' -> {cell.coordinate} ({target}) with: {str(value)[:50]}...")
             
         except Exception as e:
-            print(f"  ✗ Error filling '{label}': {e}")
+            log(f"  ✗ Error filling '{label}': {e}")
             import traceback
-            traceback.print_exc()
+            log(traceback.format_exc().rstrip())
             skipped_count += 1
             continue  # Continue with next field even if this one fails
     
+    if log_lines:
+        sys.stdout.write("\n".join(log_lines) + "\n")
+        sys.stdout.flush()
+    return filled_count, skipped_count
+
+
+def scan_template(template):
+    """Detect the form fields of a template, returns (fields, writable_cells)"""
+    # Open the template read-only for the scanning pass (streaming parser, much faster on large files)
+    # (keep_links=False: the scan never needs external link parts, so skip parsing them;
+    # no data_only: a formula without a cached value must read as occupied, like at fill time)
+    wb_ro = load_workbook(template, read_only=True, keep_links=False)
+    ws_ro = wb_ro.active
+    
+    merged_map = read_merged_map(template, ws_ro)
+    
+    print("Merged cells found:")
+    print(f"Total merged ranges: {len(merged_map)}")
+    if merged_map:
+        print("\n".join(f"  {merged_range} -> {top_left}" for merged_range, top_left in merged_map.items()))
+    else:
+        print("No merged cells found in the worksheet.")
+    
+    merged_cell_index = build_merged_cell_index(merged_map)
+    
+    print("\n=== SCANNING FOR FORM FIELDS ===")
+    
+    # Snapshot the values once (no Cell objects): random cell access re-parses the sheet in read-only mode.
+    # The declared <dimension> can be stale (too small), so iterate the rows actually stored instead
+    ws_ro.reset_dimensions()
+    rows = list(ws_ro.iter_rows(values_only=True))
+    wb_ro.close()
+
+    # Only a merged range's top-left cell holds its value; blank out leftovers in
+    # the covered cells, which Excel neither shows nor keeps on save
+    for (row, column), (_, top_left) in merged_cell_index.items():
+        if (row, column) != top_left and row <= len(rows) and column <= len(rows[row - 1]) \
+                and rows[row - 1][column - 1] is not None:
+            stale_row = list(rows[row - 1])
+            stale_row[column - 1] = None
+            rows[row - 1] = tuple(stale_row)
+
+    fields = detect_fields(rows, merged_cell_index)
+    
+    print("\n=== FIELD DETECTION ANALYSIS ===")
+    print(f"Total potential fields found (after improved filtering): {len(fields)}")
+    print(f"Total fields found: {len(fields)}")
+    
+    print("\nDetected fields (label -> field cell):")
+    if fields:
+        print("\n".join(f"  '{label}' -> {target}" for label, target in fields.items()))
+    else:
+        print("No fields found in the worksheet after filtering.")
+    
+    return fields, build_writable_cells(fields, merged_cell_index)
+
+
+def fill_template(template, output, fields, data, writable_cells):
+    """Fill a template with the AI-generated data and save it to output"""
+    # Only now open the template writable for filling; saving to the output path
+    # leaves the template untouched, so no on-disk copy is needed
+    wb = load_workbook(template)
+    ws = wb.active
+    
+    print("\nFilling Excel with AI-generated data...")
+    
+    filled_count, skipped_count = fill_fields(ws, fields, data, writable_cells)
+    
     print(f"\nSummary: {filled_count} fields filled, {skipped_count} fields skipped")
     
-    # Save the output file
-    output_filename = "sample_output.xlsx"
-    wb.save(output_filename)
-    print(f"\nExcel file saved as: {output_filename}")
-else:
-    print("\nNo fields to process. Skipping AI data generation.")
\ No newline at end of file
+    # Save the output file once, to a temporary file next to it, then rename it into
+    # place so an interrupted save never leaves a truncated workbook behind
+    tmp_output = f"{output}.{os.getpid()}.tmp"
+    try:
+        wb.save(tmp_output)
+        os.replace(tmp_output, output)
+    except BaseException:
+        # The save may have failed before the temporary file was created
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_output)
+        raise
+    print(f"\nExcel file saved as: {output}")
+
+
+def get_output_path(template):
+    """sample.xlsx -> sample_output.xlsx"""
+    return f"{os.path.splitext(template)[0]}_output.xlsx"
+
+
+def main(template="sample.xlsx", output="sample_output.xlsx"):
+    fields, writable_cells = scan_template(template)
+    
+    if not fields:
+        print("\nNo fields to process. Skipping AI data generation.")
+        return
+    
+    # Get field labels (keys from fields dictionary)
+    field_labels = list(fields.keys())
+    
+    # Call AI to get dynamic data (set USE_BATCH_API=1 to go through the cheaper Batch API)
+    if os.getenv("USE_BATCH_API") == "1":
+        data = get_data_from_ai_batch({template: field_labels}).get(template)
+        if data is None:
+            print(f"\nBatch API returned no data for {template}, falling back to a direct call")
+            data = get_data_from_ai(field_labels)
+    else:
+        data = get_data_from_ai(field_labels)
+    
+    fill_template(template, output, fields, data, writable_cells)
+
+
+def get_data_for_many_from_ai_batch(labels_by_template):
+    """Like get_data_for_many_from_ai, through one Batch API job; the templates the
+    batch couldn't answer go through the regular calls."""
+    results = get_data_from_ai_batch(labels_by_template)
+    missing = {template: field_labels for template, field_labels in labels_by_template.items()
+               if template not in results}
+    if missing:
+        print(f"\nNo batch data for {len(missing)} template(s), falling back to direct calls")
+        results.update(get_data_for_many_from_ai(missing))
+    return results
+
+
+def main_many(templates):
+    """Process several templates as a pipeline: the openpyxl phases run in a process pool,
+    the AI calls in a thread pool (network-bound) or, for large runs, one Batch API job.
+    An AI call goes out as soon as the finished scans fill it, and a template is filled
+    as soon as its data arrives."""
+    # Only a run this large can need a batch job, and the number of distinct forms
+    # is known once every scan is done, so such runs hold their AI calls until then
+    may_batch = os.getenv("USE_BATCH_API") == "1" or len(templates) >= BATCH_MIN_TEMPLATES
+    
+    with ProcessPoolExecutor() as pool, ThreadPoolExecutor(max_workers=AI_MAX_WORKERS) as ai_pool:
+        scans = {}
+        templates_by_key = {}  # templates with the same field labels (copies of one form) share an AI request
+        data_by_key = {}
+        unrequested = {}  # first template of each label set still waiting for its AI call -> field labels
+        filled = []
+        scanning = {pool.submit(scan_template, template): template for template in templates}
+        running = set(scanning)
+        
+        def fill(template, data):
+            fields, writable_cells = scans[template]
+            filled.append(pool.submit(fill_template, template, get_output_path(template), fields, data, writable_cells))
+        
+        def request(labels_by_template, get_data=get_data_for_many_from_ai):
+            get_ai_client()  # create the shared client before the worker threads use it
+            running.add(ai_pool.submit(get_data, labels_by_template))
+        
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.discard(future)
+                template = scanning.pop(future, None)
+                if template is None:
+                    # AI data arrived: fill every template sharing the label set
+                    for first, data in future.result().items():
+                        key = get_ai_cache_key(scans[first][0])
+                        data_by_key[key] = data
+                        for same_form in templates_by_key[key]:
+                            fill(same_form, data)
+                    continue
+                
+                scans[template] = future.result()
+                field_labels = list(scans[template][0])
+                if not field_labels:
+                    continue
+                key = get_ai_cache_key(field_labels)
+                if key in templates_by_key:
+                    templates_by_key[key].append(template)
+                    if key in data_by_key:
+                        fill(template, data_by_key[key])
+                    continue
+                templates_by_key[key] = [template]
+                data = get_cached_ai_data(field_labels)
+                if data is not None:
+                    data_by_key[key] = data
+                    fill(template, data)
+                    continue
+                unrequested[template] = field_labels
+                if not may_batch:
+                    # Send every call that can't take more templates, keep filling the last one
+                    *full_groups, unrequested = group_templates_for_ai(unrequested)
+                    for group in full_groups:
+                        request(group)
+            
+            if not scanning and unrequested:
+                if may_batch and (os.getenv("USE_BATCH_API") == "1" or len(templates_by_key) >= BATCH_MIN_TEMPLATES):
+                    request(unrequested, get_data_for_many_from_ai_batch)
+                else:
+                    request(unrequested)
+                unrequested = {}
+        
+        for fill_future in filled:
+            fill_future.result()
+        
+        if not templates_by_key:
+            print("\nNo fields to process. Skipping AI data generation.")
+        for key, same_form in templates_by_key.items():
+            if key not in data_by_key:
+                print(f"\nNo AI data for {', '.join(same_form)}, skipped")
+
+
+if __name__ == "__main__":
+    # Usage: python app.py [template.xlsx ...] (defaults to sample.xlsx)
+    templates = sys.argv[1:]
+    if len(templates) > 1:
+        main_many(templates)
+    elif templates:
+        main(templates[0], get_output_path(templates[0]))
+    else:
+        main()